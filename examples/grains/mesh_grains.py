@@ -1,7 +1,7 @@
 from pylab import *
 import triangle as tr
 import json as json
-from scipy.sparse.linalg import spsolve
+from scipy.sparse.linalg import spsolve, factorized
 # from shapely.geometry import Polygon as shp_Polygon
 from shapely import wkt as shp_wkt
 
@@ -9,52 +9,34 @@ from shapely import wkt as shp_wkt
 with open('grains.json') as the_file :
     boundaries = json.load(the_file)
 
-Ts = { 'segments' : [], 'vertices' : [], 'segment_markers' : [], 'holes' :[] }
-
-
-for interior in shp_wkt.loads( boundaries['box'] ).interiors : # there is only one interior
-
-    for point in interior.coords[:-1] :
-
-        Ts['vertices'] += [ point ]
-
-        try :
-            vertex_index += 1
-        except :
-            vertex_index = 0
-
-        if vertex_index > 0 :
-            Ts['segments'] += [ [ vertex_index - 1, vertex_index ] ]
-
-    Ts['segments'] += [ [ vertex_index, 0 ] ]
-
-Ts['segment_markers'] = ( -arange( 1, 5 ) ).tolist()
+box = shp_wkt.loads( boundaries['box'] )
+grains = [ shp_wkt.loads( grain ) for grain in boundaries['grains'] ]
 
 shrink_factor = .97
 
-for grain in boundaries['grains'] :
-
-    points = []
+rings = [ asarray( interior.coords )[:-1] for interior in box.interiors ] # there is only one interior
+holes = empty( ( len( grains ), 2 ) )
 
-    grain = shp_wkt.loads( grain )
-    center = grain.centroid
-    Ts['holes'] += [ [center.x, center.y] ]
+for grain_index, grain in enumerate( grains ) :
+    center = asarray( grain.centroid.coords )[0]
+    holes[grain_index] = center
+    rings += [ center + shrink_factor*( asarray( grain.exterior.coords )[:-1] - center ) ]
 
-    for point in grain.exterior.coords[:-1] :
+offsets = cumsum( [ 0 ] + [ len( ring ) for ring in rings ] ) # index of the first vertex of each ring
 
-        point = center.x + shrink_factor*( point[0] - center.x ), center.y + shrink_factor*( point[1] - center.y )
+Ts = {
+    'vertices' : empty( ( offsets[-1], 2 ) ),
+    'segments' : empty( ( offsets[-1], 2 ), dtype = int32 ),
+    'segment_markers' : -5*ones( offsets[-1], dtype = int32 ), # grains
+    'holes' : holes
+    }
 
-        points += [ point ]
-        vertex_index += 1
+for ring_index, ring in enumerate( rings ) :
+    ring_indices = arange( offsets[ring_index], offsets[ring_index + 1] )
+    Ts['vertices'][ring_indices] = ring
+    Ts['segments'][ring_indices] = column_stack( [ ring_indices, roll( ring_indices, -1 ) ] ) # closed ring
 
-        if len(points) > 1 :
-            Ts['segments'] += [ [ vertex_index - 1, vertex_index ] ]
-            Ts['segment_markers'] += [ -5 ]
-
-    Ts['segments'] += [ [ vertex_index, vertex_index - len(points) + 1 ] ]
-    Ts['segment_markers'] += [ -5 ]
-
-    Ts['vertices'] += points
+Ts['segment_markers'][ : offsets[1] ] = -arange( 1, offsets[1] + 1 ) # box
 
 ###################
 #
@@ -149,12 +131,15 @@ for _ in range(3) :
         pass
 
     FE_matrices = script.get_output( Th = Th )
+    unit_field = ones( len( FE_matrices['X'] ) )
+
     M = FE_matrices['stiffness'] - 1/epsilon*( FE_matrices['top'] + FE_matrices['bottom'] )
-    B = FE_matrices['top']@( FE_matrices['X']*0 + 1 )
+    B = FE_matrices['top']@unit_field
     c = spsolve( M, B )
 
 p = pyff.get_projector( Th, 'P2', 'P1' )
-gradient = spsolve( FE_matrices['gramian'].T@FE_matrices['gramian'], FE_matrices['gramian'].T@FE_matrices['dx']@c ), spsolve(FE_matrices['gramian'].T@ FE_matrices['gramian'], FE_matrices['gramian'].T@FE_matrices['dy']@c )
+solve_gramian = factorized( ( FE_matrices['gramian'].T@FE_matrices['gramian'] ).tocsc() ) # one factorization for both components
+gradient = solve_gramian( FE_matrices['gramian'].T@FE_matrices['dx']@c ), solve_gramian( FE_matrices['gramian'].T@FE_matrices['dy']@c )
 
 Xt = [] # centroids of triangles
 At = [] # areas of triangles
@@ -24,10 +24,11 @@
 # G. Seizilles, E. Lajeunesse, Physical Review Letters, 123, 014501, 2019
 
 import numpy as np
+import os
 import re
 import csv
 import subprocess
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, coo_matrix
 from tempfile import NamedTemporaryFile
 import warnings
 from platform import system
@@ -39,9 +40,52 @@ from .FreeFemTools.edpTools import *
 
 default_sparse_matrix = csr_matrix
 
-def parse_FreeFem_output( FreeFem_str, flag ) :
+numerical_dtypes = { 'float' : np.float64, 'int' : np.int64 }
 
-    return FreeFem_str.split( flag + '\n' )[1]
+def index_FreeFem_output( FreeFem_str ) :
+    '''
+    Locates all flagged outputs in a single scan of FreeFem_str.
+
+    FreeFem_str -> { flag : ( start, end ) }, where FreeFem_str[ start : end ] lies between the first two occurrences of flag.
+    '''
+
+    flags_index = {}
+    starts = {}
+
+    for match in re.finditer( '^(' + re.escape( flagize( '' ) ) + '.*)\n', FreeFem_str, re.MULTILINE ) :
+
+        flag = match.group(1)
+
+        if not flag in starts :
+            starts[flag] = match.end()
+
+        elif not flag in flags_index :
+            flags_index[flag] = starts[flag], match.start()
+
+    return flags_index
+
+def parse_FreeFem_output( FreeFem_str, flag, flags_index = None ) :
+    '''
+    Returns the part of FreeFem_str between the first two occurrences of flag.
+
+    flags_index (optional) : output of index_FreeFem_output( FreeFem_str ), to avoid scanning FreeFem_str again
+    '''
+
+    try :
+        start, end = flags_index[flag]
+        return FreeFem_str[ start : end ]
+
+    except ( TypeError, KeyError ) : # no index, or flag not at the beginning of a line
+        pass
+
+    flag = flag + '\n'
+    start = FreeFem_str.index( flag ) + len( flag )
+    end = FreeFem_str.find( flag, start )
+
+    if end < 0 :
+        return FreeFem_str[ start : ]
+
+    return FreeFem_str[ start : end ]
 
 def parse_FreeFem_error_message( message ) :
     '''
@@ -53,29 +97,32 @@ def parse_FreeFem_error_message( message ) :
     except :
         return None
 
-def FreeFem_str_to_matrix( FreeFem_str, matrix_name = None, flag = None, sparse_matrix = None, verbose = False, max_header_length = 15 ) :
+def FreeFem_str_to_matrix( FreeFem_str, matrix_name = None, flag = None, sparse_matrix = None, verbose = False, max_header_length = 15, flags_index = None ) :
     '''
+    flags_index (optional) : output of index_FreeFem_output( FreeFem_str ), when several matrices are read from the same output
     '''
 
     if not flag is None :
-        FreeFem_lines = parse_FreeFem_output( FreeFem_str, flag ).split('\n')
+        FreeFem_str = parse_FreeFem_output( FreeFem_str, flag, flags_index = flags_index )
 
     elif not matrix_name is None:
         flag = flagize( matrix_name ) # '# MATRIX ' + matrix_name
-        FreeFem_lines = parse_FreeFem_output( FreeFem_str, flag ).split('\n')
+        FreeFem_str = parse_FreeFem_output( FreeFem_str, flag, flags_index = flags_index )
 
-    else :
-        FreeFem_lines = FreeFem_str.split('\n')
+    line_start = 0
+
+    for _ in range( max_header_length ) :
 
-    for line_index in range( max_header_length ) :
+        line_end = FreeFem_str.find( '\n', line_start )
+        header_line = FreeFem_str[ line_start : line_end ]
 
         try :
-            header_numbers = [ int( word ) for word in FreeFem_lines[ line_index ].split() ]
+            header_numbers = [ int( word ) for word in header_line.split() ]
             header_numbers[1] # there should be at least two integers in this line
             break
 
         except :
-            pass
+            line_start = line_end + 1
 
     try :
         nb_row, nb_col, is_symmetric, nb_coef = header_numbers # FreeFem++ 3.6
@@ -85,11 +132,20 @@ def FreeFem_str_to_matrix( FreeFem_str, matrix_name = None, flag = None, sparse_
         nb_row, nb_col, nb_coef, _, _, _, _ = header_numbers # FreeFem++ 4.6
         python_style_index = True # indices start at 0
 
-    I, J, coef = loadstr( '\n'.join(  FreeFem_lines[ line_index + 1 : line_index + 1 + nb_coef ] ) ).T
+    # coefficients run from the line after the header to the next comment (flag) line, if any
+    data_start = line_end + 1
+    data_end = FreeFem_str.find( '\n#', data_start )
 
-    I = np.array([ int(x) for x in I ] )
-    J = np.array([ int(x) for x in J ] )
-    coef = np.array( [ float(x) for x in coef ] )
+    if data_end < 0 :
+        data_end = len( FreeFem_str )
+
+    data = loadstr( FreeFem_str[ data_start : data_end ], dtype = 'float' )[ :nb_coef ]
+
+    index_dtype = get_index_dtype( nb_row, nb_col, nb_coef )
+
+    I = data[:,0].astype( index_dtype )
+    J = data[:,1].astype( index_dtype )
+    coef = data[:,2]
 
     if not python_style_index :
         I -= 1
@@ -97,13 +153,16 @@ def FreeFem_str_to_matrix( FreeFem_str, matrix_name = None, flag = None, sparse_
 
 
     if verbose :
-        print('Header line', FreeFem_lines[ line_index ] )
+        print('Header line', header_line )
         print('nb_row, nb_col, nb_coef', nb_row, nb_col, nb_coef)
         print('len(I)',len(I))
 
 
     if sparse_matrix is None :
-        return default_sparse_matrix( ( coef, (I, J) ), ( nb_row, nb_col ) )
+        sparse_matrix = default_sparse_matrix
+
+    if sparse_matrix is csr_matrix :
+        return triplets_to_csr( coef, I, J, ( nb_row, nb_col ) )
 
     elif sparse_matrix == 'raw' :
         return ( coef, (I, J) ), ( nb_row, nb_col )
@@ -111,20 +170,49 @@ def FreeFem_str_to_matrix( FreeFem_str, matrix_name = None, flag = None, sparse_
     else :
         return sparse_matrix( ( coef, (I, J) ), ( nb_row, nb_col ) )
 
+def get_index_dtype( *maximal_values ) :
+    '''
+    Smallest integer type (int32 or int64) for the indices of a sparse matrix.
+
+    int32 indices take half the memory of scipy's default int64 indices, and scipy keeps them through format conversions.
+    '''
+
+    if max( maximal_values ) <= np.iinfo( np.int32 ).max :
+        return np.int32
+
+    return np.int64
+
+def triplets_to_csr( coef, I, J, shape ) :
+    '''
+    ( coef, I, J ), shape -> csr_matrix
+
+    When rows come in increasing order (FreeFem++ 3.6 output), the row pointer is computed directly.
+    Otherwise (FreeFem++ 4.6 output), the triplets are converted from the COO format.
+    '''
+
+    if np.all( I[1:] >= I[:-1] ) :
+        indptr = np.zeros( shape[0] + 1, dtype = I.dtype )
+        indptr[1:] = np.cumsum( np.bincount( I, minlength = shape[0] ) )
+        matrix = csr_matrix( ( coef, J, indptr ), shape = shape, copy = True ) # sum_duplicates works in place
+
+    else :
+        matrix = coo_matrix( ( coef, (I, J) ), shape = shape ).tocsr()
+
+    matrix.sum_duplicates()
+
+    return matrix
+
 def FreeFem_str_to_vector( Freefem_str, dtype = 'float' ) :
-    return  loadstr( Freefem_str[:-1], dtype = dtype ).flatten( )
+    return  loadstr( Freefem_str[:-1], dtype = dtype ).ravel() # no copy
 
 def FreeFem_str_to_mesh( FreeFem_str ) :
 
-    FreeFem_str = '\n' + FreeFem_str + '\n'
+    flags_index = index_FreeFem_output( FreeFem_str )
 
     FreeFem_mesh = {}
 
-    for key in ['triangles', 'boundaries'] :
-        FreeFem_mesh[key] = loadstr( FreeFem_str.split( '\n' + flagize(key) + '\n' )[1], dtype = 'int' )
-
-    for key in ['nodes'] :
-        FreeFem_mesh[key] = loadstr( FreeFem_str.split( '\n' + flagize(key) + '\n' )[1], dtype = 'float' )
+    for key, dtype in [ ( 'triangles', 'int' ), ( 'boundaries', 'int' ), ( 'nodes', 'float' ) ] :
+        FreeFem_mesh[key] = loadstr( parse_FreeFem_output( FreeFem_str, flagize(key), flags_index = flags_index ).rstrip('\n'), dtype = dtype )
 
     x, y, node_labels = FreeFem_mesh['nodes'].T
     node_labels = list( map( lambda x: int(x), node_labels ) )
@@ -132,11 +220,7 @@ def FreeFem_str_to_mesh( FreeFem_str ) :
     triangles = FreeFem_mesh['triangles'][:,:-1]
     triangle_labels = FreeFem_mesh['triangles'][:,-1]
 
-    boundary_edges = {}
-
-    for edge in FreeFem_mesh['boundaries'] :
-        # print(edge)
-        boundary_edges.update( FreeFem_edge_to_boundary_edge( edge, triangles ) )
+    boundary_edges = FreeFem_edges_to_boundary_edges( FreeFem_mesh['boundaries'], triangles )
 
     mesh = TriMesh(
         x, y,
@@ -162,51 +246,80 @@ def find_triangle_index( triangles, start_node, end_node ) :
 
     return triangle_index
 
-
-
-def FreeFem_edge_to_boundary_edge( FreeFem_edge, triangles, flip_reversed_edges = True ) :
+def FreeFem_edges_to_boundary_edges( FreeFem_edges, triangles, flip_reversed_edges = True ) :
     '''
-    ( start_node, end_node, label_integer ) -> { ( triangle_index, triangle_node_index ) : label_integer }
+    [ ( start_node, end_node, label_integer ), ... ] -> { ( triangle_index, triangle_node_index ) : label_integer, ... }
+
+    All the boundary edges of a mesh are matched at once: the oriented edges of the triangulation are encoded
+    as start_node*nb_nodes + end_node and sorted, and the boundary edges are looked up with np.searchsorted.
     '''
 
-    start_node, end_node, label_integer = FreeFem_edge
+    triangles = np.asarray( triangles, dtype = np.int64 ).reshape( -1, 3 )
+    FreeFem_edges = np.asarray( FreeFem_edges, dtype = np.int64 ).reshape( -1, 3 )
+    start_nodes, end_nodes, labels = FreeFem_edges.T
+
+    nb_nodes = max( triangles.max( initial = 0 ), FreeFem_edges[:, :2].max( initial = 0 ) ) + 1
+
+    # edge number 3*triangle_index + triangle_node_index starts at that node
+    edge_keys = ( triangles*nb_nodes + np.roll( triangles, -1, axis = 1 ) ).ravel()
+    edge_order = np.argsort( edge_keys, kind = 'stable' )
+    sorted_keys = edge_keys[ edge_order ]
 
-    triangle_index = find_triangle_index( triangles, start_node, end_node )
+    def find_edges( start_nodes, end_nodes ) :
 
-    if triangle_index is None and flip_reversed_edges:
+        keys = start_nodes*nb_nodes + end_nodes
+
+        if len( sorted_keys ) == 0 :
+            return np.zeros( len( keys ), dtype = np.int64 ), np.zeros( len( keys ), dtype = bool )
+
+        positions = np.searchsorted( sorted_keys, keys ).clip( max = len( sorted_keys ) - 1 )
+
+        return edge_order[ positions ], sorted_keys[ positions ] == keys
+
+    edge_numbers, found = find_edges( start_nodes, end_nodes )
+
+    if flip_reversed_edges and not found.all() :
         warnings.warn('Reversing some edges')
-        start_node, end_node = end_node, start_node
-        triangle_index = find_triangle_index( triangles, start_node, end_node )
+        reversed_edge_numbers, found_reversed = find_edges( end_nodes, start_nodes )
+        edge_numbers = np.where( found, edge_numbers, reversed_edge_numbers )
+        found |= found_reversed
 
-    if triangle_index is None :
+    if not found.all() :
         warnings.warn('Could not find some boundary edges. They are lost.' )
-        return {}
 
-    else :
-        node_index_in_triangle = triangles[triangle_index].tolist().index( start_node )
-        return { ( triangle_index, node_index_in_triangle ) : label_integer  }
+    triangle_indices, triangle_node_indices = np.divmod( edge_numbers[ found ], 3 )
+
+    return dict( zip( zip( triangle_indices.tolist(), triangle_node_indices.tolist() ), labels[ found ].tolist() ) )
+
+def FreeFem_edge_to_boundary_edge( FreeFem_edge, triangles, flip_reversed_edges = True ) :
+    '''
+    ( start_node, end_node, label_integer ) -> { ( triangle_index, triangle_node_index ) : label_integer }
+    '''
+
+    return FreeFem_edges_to_boundary_edges( [ FreeFem_edge ], triangles, flip_reversed_edges = flip_reversed_edges )
 
 def savemesh( mesh, filename ) :
     '''
     Saves mesh in FreeFem++ format in a .msh file.
     '''
 
-    with open( filename, 'w' ) as the_file :
+    # FreeFem++ node indices start at 1
+    nodes = np.column_stack( [ mesh.x, mesh.y, mesh.node_labels ] )
 
-        # nv, nt, ne
-        the_file.write( str( [ len( mesh.x), len( mesh.triangles ), len( mesh.boundary_edges ) ] )[1:-1].replace(',',' ') + '\n' )
+    triangles = np.column_stack( [ np.asarray( mesh.triangles, dtype = np.int64 ), np.asarray( mesh.triangle_labels, dtype = np.int64 ) ] )
+    triangles[:, :3] += 1
 
-        # vertices
-        for node_index in range( len( mesh.x ) ) :
-            the_file.write( str( mesh.x[node_index] ) + ' ' + str( mesh.y[node_index] ) + ' ' + str( mesh.node_labels[node_index] ) + '\n' )
+    edges = np.asarray( mesh.get_boundary_edges(), dtype = np.int64 ).reshape( -1, 3 )
+    edges[:, :2] += 1
 
-        # triangles
-        for tri_index, triangle in enumerate( mesh.triangles ) :
-            the_file.write( str( list( np.array( triangle ) + 1 ) )[1:-1].replace(',',' ') + ' ' + str( mesh.triangle_labels[tri_index] ) + '\n' )
+    with open( filename, 'w' ) as the_file :
+
+        # nv, nt, ne
+        the_file.write( '%d %d %d\n' % ( len( mesh.x), len( mesh.triangles ), len( mesh.boundary_edges ) ) )
 
-        # edges
-        for edge in mesh.get_boundary_edges() :
-            the_file.write( str( list( np.array( edge ) + np.array([ 1, 1, 0 ]) ) )[1:-1].replace(',',' ') + '\n' )
+        np.savetxt( the_file, nodes, fmt = '%.17g %.17g %d' )
+        np.savetxt( the_file, triangles, fmt = '%d %d %d %d' )
+        np.savetxt( the_file, edges, fmt = '%d %d %d' )
 
     return filename
 
@@ -215,123 +328,155 @@ def loadstr( data_str, delimiter = None, dtype = 'float', skip_rows = 0 ) :
 
     '''
     An approximation of np.loadtxt that applies to str.
+
+    Numerical data is parsed in one pass by np.fromstring. Anything else
+    (dtype = 'str', or tokens that are not numbers) falls back to a line-by-line parse.
     '''
 
+    if skip_rows > 0 :
+        data_str = data_str.split( '\n', skip_rows )[skip_rows:]
+        data_str = data_str[0] if len( data_str ) > 0 else ''
 
-    if dtype == 'float' :
-        def conversion_try( x ) :
-            return float( x )
+    first_line_end = data_str.find( '\n' )
+    nb_columns = len( data_str[ : first_line_end if first_line_end >= 0 else len( data_str ) ].split( delimiter ) ) # without splitting the whole payload
 
-    elif dtype == 'int' :
-        def conversion_try( x ) :
-            return int( x )
+    if dtype in numerical_dtypes.keys() :
 
-    else :
-        def conversion_try( x ) :
-            return x
+        if not delimiter is None :
+            numbers_str = data_str.replace( delimiter, ' ' )
+        else :
+            numbers_str = data_str
 
-    def conversion(x) :
-        try :
-            return conversion_try(x)
-        except :
-            return x
+        with warnings.catch_warnings() :
+            warnings.simplefilter( 'error', DeprecationWarning ) # older numpy only warns on unmatched data
+
+            try :
+                data = np.fromstring( numbers_str, sep = ' ', dtype = numerical_dtypes[dtype] ).reshape( -1, nb_columns )
+            except ( ValueError, DeprecationWarning ) :
+                data = None # not an array of numbers
+
+        if not data is None and has_one_row_per_line( data, data_str, nb_columns, delimiter = delimiter ) : # reshape alone does not catch ragged rows
+            return data
+
+    return loadstr_by_line( data_str, delimiter = delimiter, dtype = dtype )
+
+def has_one_row_per_line( data, data_str, nb_columns, delimiter = None ) :
+    '''
+    Cheap check that data, parsed from data_str, has one row per line of data_str.
+
+    The number of rows is compared with the number of lines, and the width of the last line with nb_columns.
+    data_str is neither copied nor scanned per character.
+    '''
+
+    end = len( data_str )
+
+    while end > 0 and data_str[ end - 1 ].isspace() : # trailing blank lines
+        end -= 1
+
+    nb_lines = data_str.count( '\n', 0, end ) + 1
+    last_line = data_str[ data_str.rfind( '\n', 0, end ) + 1 : end ]
+
+    return len( data ) == nb_lines and len( last_line.split( delimiter ) ) == nb_columns
+
+def loadstr_by_line( data_str, delimiter = None, dtype = 'float' ) :
+    '''
+    Slow version of loadstr. Tokens which cannot be converted to dtype are kept as str.
+    '''
+
+    conversion = { 'float' : float, 'int' : int }.get( dtype, str )
 
     data = []
 
-    for data_line in data_str.split('\n')[skip_rows:] :
-        data += [ [ conversion( number ) for number in data_line.split( delimiter ) ] ]
+    for data_line in data_str.split('\n') :
+
+        data_row = []
+
+        for number in data_line.split( delimiter ) :
+            try :
+                data_row += [ conversion( number ) ]
+            except ValueError :
+                data_row += [ number ]
+
+        data += [ data_row ]
 
     return np.array(data)
 
 
 def run_FreeFem( edp_str = None, verbose = False, stdin = None, platform = None ) :
     '''
-    Run FreeFem++ on script edp_str, and returns Popen output.
+    Run FreeFem++ on script edp_str, and returns its output.
+
+    If FreeFem++ fails, or cannot be found, the error is printed and None is returned.
     '''
 
     if stdin is None :
         stdin = []
 
-    temporary_files = []
-
     if platform is None :
         platform = system()
 
-    if platform in [ 'Linux', 'Darwin' ] : # Linux or MacOS
-
-        try :
-            edp_str = edp_str.replace( '"',  "\"'\"" )
-            command = [ 'FreeFem++ -v 0 <( printf "' + edp_str + '" )' ]
-            print_error_message = True # default
-        except :
-            command = [ 'FreeFem++' ]
-            print_error_message = False # to get FreeFem version as output
-
-        Popen_kwargs = dict( args = command, stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.PIPE, shell = True, executable="/bin/bash")
+    if not platform in [ 'Linux', 'Darwin', 'Windows' ] :
+        print('Unable to identify platform. Cannot run FreeFem++.')
+        return None
 
-    elif platform == 'Windows' : # write edp code in temporaryFaile from Stanisław Żukowski (Oct. 2020)
+    if edp_str is None :
+        command = [ 'FreeFem++' ]
+        print_error_message = False # to get FreeFem version as output
 
-        try :
-            with NamedTemporaryFile( suffix = '.edp', mode = 'w', delete = False ) as edp_temp_file:
-                edp_temp_file.write( edp_str )
-                temporary_files += [edp_temp_file]
+    else : # write edp code in temporary file, from Stanisław Żukowski (Oct. 2020). stdin is kept for the inputs read by cin.
+        with NamedTemporaryFile( suffix = '.edp', mode = 'w', delete = False ) as edp_temp_file:
+            edp_temp_file.write( edp_str )
 
-            print_error_message = True  # default
-            command = [ 'FreeFem++', '-v', '0', edp_temp_file.name ]
+        command = [ 'FreeFem++', '-v', '0', edp_temp_file.name ]
+        print_error_message = True # default
 
-        except :
-            command = [ 'FreeFem++' ]
-            print_error_message = False # to get FreeFem version as output
+    if verbose :
+        print('\nRunning FreeFem++...')
 
-        Popen_kwargs = dict( args = command, stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.PIPE, shell = True)
+    try :
+        proc = subprocess.run( command, input = input_to_stdin( stdin ).encode(), stdout = subprocess.PIPE, stderr = subprocess.PIPE ) # Freefem outputs errors in console
+        output, returncode = proc.stdout.decode('utf-8'), proc.returncode
 
-    else :
-        print('Unable to identify platform. Cannot run FreeFem++.')
+    except FileNotFoundError : # FreeFem++ not installed: fail like the shell did
+        output, returncode = '', 127
 
-    with subprocess.Popen( **Popen_kwargs ) as proc :
+    finally :
+        if not edp_str is None :
+            os.remove( edp_temp_file.name )
 
+    if not returncode :
         if verbose :
-            print('\nRunning FreeFem++...')
-
-        output, error = proc.communicate( input = input_to_stdin( stdin ).encode() ) # Freefem outputs errors in console
-
-        for temporary_file in temporary_files :
-            temporary_file.close()
+            print('\nFreeFem++ ran successfully.\n')
+        return output
 
+    else :
 
-        if not proc.returncode :
-            if verbose :
-                print('\nFreeFem++ ran successfully.\n')
-            return output.decode('utf-8')
+        if print_error_message :
 
-        else :
+            print('\n-------------------')
+            print('FreeFem++ error :')
+            print('-------------------')
+            print( output )
+            print('-------------------\n')
+            print('Corresponding line in FreeFem script:\n')
+            try :
+                print( get_edp_line( edp_str, parse_FreeFem_error_message( output ) ) + '\n' )
+                print('(Use edpScript.pprint to display full script.)\n')
+            except :
+                print('Could not get corresponding line.\n')
 
-            if print_error_message :
 
+            if verbose :
                 print('\n-------------------')
-                print('FreeFem++ error :')
+                print('edp file :')
                 print('-------------------')
-                print( output.decode( 'utf-8' ) )
+                edp_pprint( edp_str )
                 print('-------------------\n')
-                print('Corresponding line in FreeFem script:\n')
-                try :
-                    print( get_edp_line( edp_str, parse_FreeFem_error_message( output.decode( 'utf-8' ) ) ) + '\n' )
-                    print('(Use edpScript.pprint to display full script.)\n')
-                except :
-                    print('Could not get corresponding line.\n')
 
+            return None
 
-                if verbose :
-                    print('\n-------------------')
-                    print('edp file :')
-                    print('-------------------')
-                    edp_pprint( edp_str )
-                    print('-------------------\n')
-
-                return None
-
-            else :
-                return output.decode('utf-8')
+        else :
+            return output
 
 def parse_FreeFem_version( version ) :
 
@@ -391,9 +536,10 @@ if __name__ == '__main__' :
     mesh = FreeFem_str_to_mesh( FreeFem_output  )
 
     matrices = {}
+    flags_index = index_FreeFem_output( FreeFem_output )
 
     for matrix_type in matrix_types :
-        matrices[ matrix_type['matrix_name'] ] = FreeFem_str_to_matrix( FreeFem_output, matrix_type['matrix_name'] )
+        matrices[ matrix_type['matrix_name'] ] = FreeFem_str_to_matrix( FreeFem_output, matrix_type['matrix_name'], flags_index = flags_index )
 
     for matrix_type in matrix_types :
         print( matrix_type['matrix_name'] )
@@ -40,7 +40,7 @@ def FreeFemize( name, type = 'variable' ) :
 
     name = name.encode('ASCII', 'ignore').decode('utf8')
 
-    name = re.sub('\W+','_', name ) # keeps only alphanumeric or underscore
+    name = re.sub(r'\W+','_', name ) # keeps only alphanumeric or underscore
 
     if type == 'variable' :
 
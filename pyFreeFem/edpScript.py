@@ -61,22 +61,27 @@ class edpOutput :
 
         return add_flags( edp, self.flag )
 
-    def parse( self, FreeFem_output ) :
+    def parse( self, FreeFem_output, flags_index = None ) :
+        '''
+        flags_index (optional) : output of index_FreeFem_output( FreeFem_output ), shared by all the outputs of a script
+        '''
+
+        FreeFem_str = parse_FreeFem_output( FreeFem_output, self.flag, flags_index = flags_index )
 
         if self.type == 'matrix' :
-            return FreeFem_str_to_matrix( parse_FreeFem_output( FreeFem_output, self.flag  ) )
+            return FreeFem_str_to_matrix( FreeFem_str )
 
         elif self.type == 'vector' :
-            return FreeFem_str_to_vector( parse_FreeFem_output( FreeFem_output, self.flag ) )
+            return FreeFem_str_to_vector( FreeFem_str )
 
         elif self.type == 'mesh' :
-            return FreeFem_str_to_mesh( parse_FreeFem_output( FreeFem_output, self.flag ) )
+            return FreeFem_str_to_mesh( FreeFem_str )
 
         elif self.type == 'real':
-            return  float( parse_FreeFem_output( FreeFem_output, self.flag ) )
+            return  float( FreeFem_str )
 
         elif self.type == 'int':
-            return  int( parse_FreeFem_output( FreeFem_output, self.flag ) )
+            return  int( FreeFem_str )
 
 class edpInput :
     '''
@@ -397,10 +402,11 @@ class edpScript :
     def parse( self, FreeFem_output ) :
 
         FreeFem_data = {}
+        flags_index = index_FreeFem_output( FreeFem_output ) # a single scan for all outputs
 
         for block in self.blocks :
             for output in block.output :
-                FreeFem_data[ output.name ] = output.parse( FreeFem_output )
+                FreeFem_data[ output.name ] = output.parse( FreeFem_output, flags_index = flags_index )
 
         return FreeFem_data
 